@@ -10,215 +10,308 @@ from astrometry.util.plotutils import *
 from astrometry.libkd.spherematch import match
 from astrometry.util.starutil_numpy import *
 from astrometry.util.fits import *
+from astrometry.util.multiproc import multiproc
 
 from optparse import *
 
 from pylab import *
 from numpy import *
 import os
+import multiprocessing
+
+try:
+    from fast_histogram import histogram1d as fast_histogram1d
+    from fast_histogram import histogram2d as fast_histogram2d
+except ImportError:
+    fast_histogram1d = fast_histogram2d = None
+
+def _hist_range(x, rng):
+    if rng is None:
+        if len(x) == 0:
+            # (like numpy)
+            return 0., 1.
+        lo,hi = x.min(), x.max()
+    else:
+        lo,hi = rng
+    if lo == hi:
+        lo,hi = lo - 0.5, hi + 0.5
+    return lo,hi
+
+def uniform_hist2d(x, y, bins=100, range=None):
+    '''
+    Like numpy's histogram2d, for uniform bins: returns (H, xedges, yedges).
+    Uses the "fast_histogram" package if it is available; otherwise
+    computes the bin indices directly and counts them with bincount().
+    '''
+    try:
+        nx,ny = bins
+    except TypeError:
+        nx = ny = bins
+    if range is None:
+        range = [None, None]
+    xlo,xhi = _hist_range(x, range[0])
+    ylo,yhi = _hist_range(y, range[1])
+    if fast_histogram2d is not None:
+        # fast_histogram excludes the upper edge, numpy includes it.
+        H = fast_histogram2d(x, y, [nx, ny],
+                             range=[[xlo, nextafter(xhi, inf)],
+                                    [ylo, nextafter(yhi, inf)]])
+    else:
+        x = ravel(x)
+        y = ravel(y)
+        I = logical_and(x >= xlo, x <= xhi)
+        I &= (y >= ylo)
+        I &= (y <= yhi)
+        if not all(I):
+            x = x[I]
+            y = y[I]
+        del I
+        ix = ((x - xlo) * (nx / float(xhi - xlo))).astype(intp)
+        iy = ((y - ylo) * (ny / float(yhi - ylo))).astype(intp)
+        # (values on the upper edge go in the last bin)
+        clip(ix, 0, nx-1, out=ix)
+        clip(iy, 0, ny-1, out=iy)
+        ix *= ny
+        ix += iy
+        H = bincount(ix, minlength=nx*ny).reshape(nx, ny).astype(float)
+    return H, linspace(xlo, xhi, nx+1), linspace(ylo, yhi, ny+1)
+
+def plot_hist2d(x, y, bins=100, range=None, scale=None,
+                xl=None, yl=None, title=None, fn=None, cbar=False):
+    '''
+    Histograms *x*,*y* (see uniform_hist2d) and shows the result, in the
+    current axes, with imshow().  Counts are multiplied by *scale*,
+    if given.  Returns (H, xedges, yedges).
+
+    If *fn* is given, makes a whole plot instead: clears the figure,
+    adds a colorbar (if *cbar*), sets equal axes, the axis labels *xl*,
+    *yl* and *title* (if given), and saves it to *fn*.
+    '''
+    if fn is not None:
+        clf()
+    (H,xe,ye) = uniform_hist2d(x, y, bins=bins, range=range)
+    if scale is not None:
+        H *= scale
+    imshow(H.T, extent=(xe[0], xe[-1], ye[0], ye[-1]), aspect='auto',
+           interpolation='nearest', origin='lower', cmap=antigray)
+    if fn is None:
+        return H,xe,ye
+    if cbar:
+        colorbar()
+    axis('equal')
+    if xl is not None:
+        xlabel(xl)
+    if yl is not None:
+        ylabel(yl)
+    if title is not None:
+        gca().set_title(title)
+    savefig(fn)
+    return H,xe,ye
+
+def hist1d(x, bins, range):
+    '''
+    Plots a histogram of *x*, like pylab's hist(), for uniform bins.
+    Uses the "fast_histogram" package if it is available.
+    '''
+    if fast_histogram1d is None:
+        return hist(x, bins, range=range)
+    lo,hi = _hist_range(x, range)
+    N = fast_histogram1d(x, bins, range=[lo, nextafter(hi, inf)])
+    edges = linspace(lo, hi, bins+1)
+    # plot the pre-computed counts
+    return hist(edges[:-1], edges, weights=N)
+
+def plot_catalog(fn, titletxt, outfn, R, offsetsfn=None):
+    '''
+    Plots the distances between pairs of sources within *R* arcsec in
+    the FITS table *fn* (with "ra", "dec" columns), to *outfn*.  If
+    *offsetsfn* is given, also plots the 2-d (RA,Dec) offsets of the
+    pairs to that file.
+    '''
+    cat = fits_table(fn)
+    xyz = radectoxyz(cat.ra, cat.dec)
+    inds,dists = match(xyz, xyz, deg2rad(R/3600.), notself=True)
+    del xyz
+    clf()
+    hist1d(rad2deg(dists) * 3600., 200, range=(0, R))
+    title(titletxt)
+    xlabel('Distance between pairs of sources (arcsec)')
+    ylabel('Counts')
+    xlim(0, R)
+    savefig(outfn)
+
+    if offsetsfn is None:
+        return
+    I1 = inds[:,0]
+    I2 = inds[:,1]
+    RA = where(cat.ra > 180, cat.ra - 360, cat.ra)
+    dra = RA[I1]-RA[I2]
+    ddec = cat.dec[I1]-cat.dec[I2]
+    #plot(dra, ddec, 'r.')
+    plot_hist2d(dra, ddec, bins=(200,200),
+                xl='dRA (deg)', yl='dDec (deg)', fn=offsetsfn)
+
+def mirrored(a):
+    '''
+    Returns the concatenation of *a* and 1-*a*, in one allocation.
+    '''
+    n = len(a)
+    m = empty(2*n, a.dtype)
+    m[:n] = a
+    subtract(1.0, a, out=m[n:])
+    return m
+
+def process_index(X):
+    '''
+    Makes the plots for one index file; X = (index filename, output
+    plot filename prefix, search radius in arcsec for the star-pairs
+    plot).  Run in parallel by the main program, so the prefix must be
+    different for each index.
+    '''
+    (indfn, prefix, R) = X
+    print('Reading index', indfn)
+    null = None
+    I = index_load(indfn, 0, null)
+    print('Loaded.')
+    NS = index_nstars(I)
+    NQ = index_nquads(I)
+    print('Index has', NS, 'stars and', NQ, 'quads')
+    DQ = index_get_quad_dim(I)
+    print('Index has "quads" with %i stars' % (DQ))
+    DC = index_get_quad_dim(I)
+    print('Index has %i-dimensional codes' % (DC))
+
+    iname = os.path.basename(I.indexname).replace('.fits', '')
+    # stars
+    print('Getting stars...')
+    stars = index_get_stars(I)
+    print(stars.shape)
+
+    # (stars are unit vectors; RA in [-180, 180])
+    ra = rad2deg(arctan2(stars[:,1], stars[:,0]))
+    dec = rad2deg(arcsin(clip(stars[:,2], -1., 1.)))
+
+    # FIXME --!
+    #ra *= cos(deg2rad(ra))
+    rng = [[-10,10],[-10,10]]
+    nbins = 100
+    binarea = (((rng[0][1] - rng[0][0]) / float(nbins)) *
+               ((rng[1][1] - rng[1][0]) / float(nbins)))
+    print('Bin area:', binarea, 'deg^2')
+    binarea *= 3600.
+    print(binarea, 'arcmin^2')
+    plot_hist2d(ra, dec, bins=nbins, range=rng, scale=1./binarea,
+                xl='RA (deg)', yl='Dec (deg)', cbar=True,
+                title='Reference source density in %s' % iname,
+                fn=prefix + 'stars-2.png')
+
+    print('Finding pairs within', R, 'arcsec')
+    inds,dists = match(stars, stars, deg2rad(R/3600.), notself=True)
+    print('inds', inds.shape, 'dists', dists.shape)
+
+    clf()
+    hist1d(rad2deg(dists) * 3600., 200, range=(0, R))
+    xlabel('Star pair distances (arcsec)')
+    ylabel('Counts')
+    xlim(0, R)
+    savefig(prefix + 'stars-1.png')
+
+
+    # codes
+    print('Getting codes...')
+    codes = index_get_codes(I)
+    print('shape', codes.shape)
+
+    # code slices
+    cx = codes[:,0]
+    cy = codes[:,1]
+    dx = codes[:,2]
+    dy = codes[:,3]
+    # Codes are normalized so that stars C,D lie in the circle with
+    # diameter AB, from (0,0) to (1,1); use a fixed range for all plots.
+    crange = [-0.3, 1.3]
+    coderange = [crange, crange]
+    plot_hist2d(cx, cy, bins=(100,100), range=coderange,
+                xl='cx', yl='cy', fn=prefix + 'codes-1.png')
+
+    # Build [cx, dx, 1-cx, 1-dx] (and the same for y) once: the first
+    # half is used for the cx,dx plot, the whole for the A-B swap plot.
+    n = len(codes)
+    xx = empty(4*n, codes.dtype)
+    yy = empty(4*n, codes.dtype)
+    for a,b,c in [(xx, cx, dx), (yy, cy, dy)]:
+        a[:n] = b
+        a[n:2*n] = c
+        subtract(1.0, a[:2*n], out=a[2*n:])
+
+    plot_hist2d(xx[:2*n], yy[:2*n], bins=(100,100), range=coderange,
+                xl='cx, dx', yl='cy, dy', fn=prefix + 'codes-2.png')
+
+    plot_hist2d(cx, dx, bins=(100,100), range=coderange,
+                xl='cx', yl='dx', fn=prefix + 'codes-3.png')
+
+    plot_hist2d(xx, yy, bins=(100,100), range=coderange,
+                xl='cx, dx', yl='cy, dy', title='duplicated for A-B swap',
+                fn=prefix + 'codes-4.png')
+
+    for pnum,arrs in [(5, [cx,cy,dx,dy]),
+                      (6, [mirrored(cx), mirrored(cy), mirrored(dx), mirrored(dy)])]:
+        clf()
+        anames = ['cx', 'cy', 'dx', 'dy']
+        sp = 0
+        for i,a1 in enumerate(arrs):
+            for j,a2 in enumerate(arrs):
+                sp += 1
+                if j > i:
+                    continue
+                subplot(4,4, sp)
+                if i == j:
+                    hist1d(a1, 100, range=crange)
+                else:
+                    plot_hist2d(a2, a1, bins=(100,100), range=coderange)
+                    axis(crange + crange)
+                    axis('scaled')
+                xticks([],[])
+                yticks([],[])
+                if i == 3:
+                    xlabel(anames[j])
+                if j == 0:
+                    ylabel(anames[i])
+        savefig(prefix + 'codes-%i.png' % pnum)
+
+
+    index_free(I)
 
 if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option('-p', '--prefix', dest='prefix', help='Prefix for output plot names')
     parser.add_option('-r', '--range', dest='range', type='float', help='Set search radius range (in arcsec) of stars-1 plot, default 15')
+    parser.add_option('-j', '--processes', dest='processes', type='int', help='Process this many index files in parallel; default: one per CPU')
     parser.set_defaults(prefix='', range=15.)
     opt,args = parser.parse_args()
 
     if 'plots' in args: # DEBUG!
-        cat = fits_table('cat2.fits')
-        xyz = radectoxyz(cat.ra, cat.dec)
-        R = 15.
-        inds,dists = match(xyz, xyz, deg2rad(R/3600.))
-        notself = (inds[:,0] != inds[:,1])
-        clf()
-        hist(rad2deg(dists[notself]) * 3600., 200)
-        title('ImSim reference catalog')
-        xlabel('Distance between pairs of sources (arcsec)')
-        ylabel('Counts')
-        xlim(0, R)
-        savefig('cat-stars-1.png')
-
-        cat = fits_table('stars3.fits')
-        xyz = radectoxyz(cat.ra, cat.dec)
-        R = 15.
-        inds,dists = match(xyz, xyz, deg2rad(R/3600.))
-        notself = (inds[:,0] != inds[:,1])
-        clf()
-        hist(rad2deg(dists[notself]) * 3600., 200)
-        title('ImSim reference catalog -- stars only')
-        xlabel('Distance between pairs of sources (arcsec)')
-        ylabel('Counts')
-        xlim(0, R)
-        savefig('cat-stars-2.png')
-
-        I1 = inds[notself,0]
-        I2 = inds[notself,1]
-        clf()
-        RA = cat.ra + (cat.ra > 180)*-360
-        dra = RA[I1]-RA[I2]
-        ddec = cat.dec[I1]-cat.dec[I2]
-        #plot(dra, ddec, 'r.')
-        (H,xe,ye) = histogram2d(dra, ddec, bins=(200,200))
-        H=H.T
-        imshow(H, extent=(min(xe), max(xe), min(ye), max(ye)), aspect='auto',
-               interpolation='nearest', origin='lower', cmap=antigray)
-
-        xlabel('dRA (deg)')
-        ylabel('dDec (deg)')
-        axis('equal')
-        savefig('cat-stars-4.png')
-
-        cat = fits_table('gals2.fits')
-        xyz = radectoxyz(cat.ra, cat.dec)
         R = 15.
-        inds,dists = match(xyz, xyz, deg2rad(R/3600.))
-        notself = (inds[:,0] != inds[:,1])
-        clf()
-        hist(rad2deg(dists[notself]) * 3600., 200)
-        title('ImSim reference catalog -- galaxies only')
-        xlabel('Distance between pairs of sources (arcsec)')
-        ylabel('Counts')
-        xlim(0, R)
-        savefig('cat-stars-3.png')
+        plot_catalog('cat2.fits', 'ImSim reference catalog',
+                     'cat-stars-1.png', R)
+        plot_catalog('stars3.fits', 'ImSim reference catalog -- stars only',
+                     'cat-stars-2.png', R, offsetsfn='cat-stars-4.png')
+        plot_catalog('gals2.fits', 'ImSim reference catalog -- galaxies only',
+                     'cat-stars-3.png', R)
         sys.exit(0)
 
-    for indfn in args:
-        print('Reading index', indfn)
-        null = None
-        I = index_load(indfn, 0, null)
-        print('Loaded.')
-        NS = index_nstars(I)
-        NQ = index_nquads(I)
-        print('Index has', NS, 'stars and', NQ, 'quads')
-        DQ = index_get_quad_dim(I)
-        print('Index has "quads" with %i stars' % (DQ))
-        DC = index_get_quad_dim(I)
-        print('Index has %i-dimensional codes' % (DC))
-
-        iname = os.path.basename(I.indexname).replace('.fits', '')
-        # stars
-        print('Getting stars...')
-        stars = index_get_stars(I)
-        print(stars.shape)
-
-        ra,dec = xyztoradec(stars)
-        ra += (ra > 180)*-360
-
-        # FIXME --!
-        #ra *= cos(deg2rad(ra))
-        rng = [[-10,10],[-10,10]]
-        clf()
-        (H,xe,ye) = histogram2d(ra, dec, bins=(100,100), range=rng)
-        H=H.T
-        binarea = (xe[1]-xe[0])*(ye[1]-ye[0])
-        print('Bin area:', binarea, 'deg^2')
-        binarea *= 3600.
-        print(binarea, 'arcmin^2')
-        imshow(H/binarea, extent=(min(xe), max(xe), min(ye), max(ye)),
-               aspect='auto',
-               interpolation='nearest', origin='lower', cmap=antigray)
-        colorbar()
-        axis('equal')
-        xlabel('RA (deg)')
-        ylabel('Dec (deg)')
-        title('Reference source density in %s' % iname)
-        savefig(opt.prefix + 'stars-2.png')
-
-        R = opt.range
-        print('Finding pairs within', R, 'arcsec')
-        inds,dists = match(stars, stars, deg2rad(R/3600.))
-        print('inds', inds.shape, 'dists', dists.shape)
-
-        notself = (inds[:,0] != inds[:,1])
-        clf()
-        hist(rad2deg(dists[notself]) * 3600., 200)
-        xlabel('Star pair distances (arcsec)')
-        ylabel('Counts')
-        xlim(0, R)
-        savefig(opt.prefix + 'stars-1.png')
-
-
-        # codes
-        print('Getting codes...')
-        codes = index_get_codes(I)
-        print('shape', codes.shape)
-
-        # code slices
-        cx = codes[:,0]
-        cy = codes[:,1]
-        dx = codes[:,2]
-        dy = codes[:,3]
-        clf()
-        (H,xe,ye) = histogram2d(cx, cy, bins=(100,100))
-        H=H.T
-        imshow(H, extent=(min(xe), max(xe), min(ye), max(ye)), aspect='auto',
-               interpolation='nearest', origin='lower', cmap=antigray)
-        axis('equal')
-        xlabel('cx')
-        ylabel('cy')
-        savefig(opt.prefix + 'codes-1.png')
-
-        clf()
-        (H,xe,ye) = histogram2d(append(cx, dx), append(cy, dy), bins=(100,100))
-        H=H.T
-        imshow(H, extent=(min(xe), max(xe), min(ye), max(ye)), aspect='auto',
-               interpolation='nearest', origin='lower', cmap=antigray)
-        axis('equal')
-        xlabel('cx, dx')
-        ylabel('cy, dy')
-        savefig(opt.prefix + 'codes-2.png')
-
-        clf()
-        (H,xe,ye) = histogram2d(cx, dx, bins=(100,100))
-        H=H.T
-        imshow(H, extent=(min(xe), max(xe), min(ye), max(ye)), aspect='auto',
-               interpolation='nearest', origin='lower', cmap=antigray)
-        axis('equal')
-        xlabel('cx')
-        ylabel('dx')
-        savefig(opt.prefix + 'codes-3.png')
-
-        clf()
-        xx = append(cx, dx)
-        yy = append(cy, dy)
-        (H,xe,ye) = histogram2d(append(xx, 1.0-xx), append(yy, 1.0-yy), bins=(100,100))
-        H=H.T
-        imshow(H, extent=(min(xe), max(xe), min(ye), max(ye)), aspect='auto',
-               interpolation='nearest', origin='lower', cmap=antigray)
-        axis('equal')
-        xlabel('cx, dx')
-        ylabel('cy, dy')
-        title('duplicated for A-B swap')
-        savefig(opt.prefix + 'codes-4.png')
-
-        for pnum,arrs in [(5, [cx,cy,dx,dy]),
-                          (6, [append(cx, 1-cx), append(cy, 1-cy), append(dx, 1-dx), append(dy, 1-dy)])]:
-            clf()
-            anames = ['cx', 'cy', 'dx', 'dy']
-            sp = 0
-            for i,a1 in enumerate(arrs):
-                for j,a2 in enumerate(arrs):
-                    sp += 1
-                    if j > i:
-                        continue
-                    subplot(4,4, sp)
-                    if i == j:
-                        hist(a1, 100, range=[-0.3, 1.3])
-                    else:
-                        (H,xe,ye) = histogram2d(a2, a1, bins=(100,100), range=[[-0.3,1.3],[-0.3,1.3]])
-                        H=H.T
-                        imshow(H, extent=(min(xe), max(xe), min(ye), max(ye)), aspect='auto',
-                               interpolation='nearest', origin='lower', cmap=antigray)
-                        axis([-0.3,1.3,-0.3,1.3])
-                        axis('scaled')
-                    xticks([],[])
-                    yticks([],[])
-                    if i == 3:
-                        xlabel(anames[j])
-                    if j == 0:
-                        ylabel(anames[i])
-            savefig(opt.prefix + 'codes-%i.png' % pnum)
-
-
-        index_free(I)
-        
+    nprocs = opt.processes
+    if nprocs is None:
+        nprocs = max(1, min(len(args), multiprocessing.cpu_count()))
+    # With more than one index, add the index name to the plot
+    # filenames so that the indices don't overwrite each other's plots.
+    prefixes = [opt.prefix] * len(args)
+    if len(args) > 1:
+        names = [os.path.basename(indfn).replace('.fits', '') for indfn in args]
+        if len(set(names)) < len(names):
+            # (same filename in different directories)
+            names = ['%s-%i' % (nm, i) for i,nm in enumerate(names)]
+        prefixes = [opt.prefix + nm + '-' for nm in names]
+    mp = multiproc(nprocs)
+    mp.map(process_index, [(indfn, prefix, opt.range)
+                           for indfn,prefix in zip(args, prefixes)])
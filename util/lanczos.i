@@ -162,6 +162,61 @@ static int LANCZOS_INTERP_FUNC(PyObject* py_ixi, PyObject* py_iyi,
         outimg = PyArray_DATA(np_outimg);
 
         for (j=0; j<N; j++, outimg++, ixi++, iyi++) {
+#if defined(__AVX2__) && defined(__FMA__)
+            // Resample 8 pixels at a time, if they are all away from
+            // the image edges.  The gathers use int32 offsets into
+            // inimg, so the image must have < 2^31 pixels.
+            if ((j + 8 <= N) && (W * H <= INT32_MAX)) {
+                int32_t offs[8], txs[8], tys[8];
+                int k;
+                for (k=0; k<8; k++) {
+                    int t;
+                    int ix = ixi[k];
+                    int iy = iyi[k];
+                    if (ix < L || ix >= (W-L) || iy < L || iy >= (H-L))
+                        break;
+                    offs[k] = (iy - L) * W + (ix - L);
+                    t = (int)((-(dx[j+k]+L) - lut0) * Nlutunit);
+                    txs[k] = MAX(0, MIN(Nlutunit-1, t)) * Nunits;
+                    t = (int)((-(dy[j+k]+L) - lut0) * Nlutunit);
+                    tys[k] = MAX(0, MIN(Nlutunit-1, t)) * Nunits;
+                }
+                if (k == 8) {
+                    int u, v;
+                    __m256 lx[2*L+1];
+                    __m256 acc = _mm256_setzero_ps();
+                    __m256 nacc;
+                    const __m256i voff = _mm256_loadu_si256((const __m256i*)offs);
+                    const __m256i vtx  = _mm256_loadu_si256((const __m256i*)txs);
+                    const __m256i vty  = _mm256_loadu_si256((const __m256i*)tys);
+                    for (u=0; u<2*L+1; u++)
+                        lx[u] = _mm256_i32gather_ps(lut + u, vtx, sizeof(float));
+                    // Lanczos kernel in y direction
+                    for (v=0; v<2*L+1; v++) {
+                        const float* inrow = inimg + v * W;
+                        __m256 ly = _mm256_i32gather_ps(lut + v, vty, sizeof(float));
+                        __m256 accx = _mm256_setzero_ps();
+                        // Lanczos kernel in x direction
+                        for (u=0; u<2*L+1; u++)
+                            accx = _mm256_fmadd_ps(lx[u],
+                                                   _mm256_i32gather_ps(inrow + u, voff,
+                                                                       sizeof(float)),
+                                                   accx);
+                        acc = _mm256_fmadd_ps(ly, accx, acc);
+                    }
+                    nacc = _mm256_mul_ps(
+                        _mm256_i32gather_ps(lut + Nunits-1, vtx, sizeof(float)),
+                        _mm256_i32gather_ps(lut + Nunits-1, vty, sizeof(float)));
+                    _mm256_storeu_ps(outimg, _mm256_div_ps(acc, nacc));
+                    // (the loop increments take care of the 8th pixel)
+                    j += 7;
+                    outimg += 7;
+                    ixi += 7;
+                    iyi += 7;
+                    continue;
+                }
+            }
+#endif
             // resample inimg[ iyi[j] + dy[j], ixi[j] + dx[j] ]
             // to outimg[ j ]
             npy_intp u,v;
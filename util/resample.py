@@ -2,8 +2,38 @@
 # Licensed under a 3-clause BSD style license - see LICENSE
 from __future__ import print_function
 from __future__ import absolute_import
+from collections import OrderedDict
+import math
+import multiprocessing
+import pickle
+from multiprocessing.pool import ThreadPool
+import threading
 import numpy as np
 
+# Recently-used target-to-input pixel mappings; see resample_with_wcs.
+_spline_cache = OrderedDict()
+_spline_cache_size = 20
+_spline_cache_lock = threading.Lock()
+
+def _wcs_cache_key(wcs):
+    '''
+    Returns a key identifying the given WCS object by value, for
+    _spline_cache, or None if it does not know how to.  Only Tan and
+    Sip objects, whose pickled state is the whole WCS, are keyed;
+    other (duck-typed) WCS classes are never cached.
+    '''
+    try:
+        from astrometry.util.util import Tan, Sip
+    except ImportError:
+        return None
+    # (exact types: subclasses may hold more state)
+    if type(wcs) not in (Tan, Sip):
+        return None
+    try:
+        return (type(wcs).__name__, pickle.dumps(wcs.__getstate__(), -1))
+    except Exception:
+        return None
+
 class ResampleError(Exception):
     pass
 class OverlapError(ResampleError):
@@ -59,7 +89,8 @@ def resample_with_wcs(targetwcs, wcs, Limages=[], L=3, spline=True,
 
     splineStep: approximate grid size
 
-    table: use Lanczos3 look-up table?
+    table: use a Lanczos look-up table?  (Ignored by the Numba
+    version of the non-C path, which evaluates the kernel exactly.)
 
     intType: type to return for integer pixel coordinates.
     (however, Yi,Xi may still be returned as int32)
@@ -77,13 +108,13 @@ def resample_with_wcs(targetwcs, wcs, Limages=[], L=3, spline=True,
     # First find the approximate bbox of the input image in
     # the target image so that we don't ask for way too
     # many out-of-bounds pixels...
-    XY = []
-    for x,y in [(0,0), (w-1,0), (w-1,h-1), (0, h-1)]:
-        # [-2:]: handle ok,ra,dec or ra,dec
-        ok,xw,yw = targetwcs.radec2pixelxy(
-            *(wcs.pixelxy2radec(float(x + 1), float(y + 1))[-2:]))
-        XY.append((xw - 1, yw - 1))
-    XY = np.array(XY)
+    # (corners, in a single vectorized WCS call)
+    cornerx = np.array([0, w-1, w-1, 0], float)
+    cornery = np.array([0, 0, h-1, h-1], float)
+    # [-2:]: handle ok,ra,dec or ra,dec
+    ok,xw,yw = targetwcs.radec2pixelxy(
+        *(wcs.pixelxy2radec(cornerx + 1, cornery + 1)[-2:]))
+    XY = np.vstack((xw - 1, yw - 1)).T
 
     x0,y0 = np.rint(XY.min(axis=0))
     x1,y1 = np.rint(XY.max(axis=0))
@@ -131,6 +162,21 @@ def resample_with_wcs(targetwcs, wcs, Limages=[], L=3, spline=True,
                 raise SmallOverlapError()
 
     if spline:
+        # The spline (or affine) mapping depends only on the two WCSes
+        # and the grid, so re-use it if we have seen this pair before
+        # (eg, when resampling an image and then its weight map).
+        key = (_wcs_cache_key(targetwcs), _wcs_cache_key(wcs), step, margin)
+        if None in key[:2]:
+            key = None
+        cached = None
+        if key is not None:
+            with _spline_cache_lock:
+                cached = _spline_cache.get(key)
+
+    if spline and cached is not None:
+        affine,xspline,yspline = cached
+
+    elif spline:
         # spline inputs  -- pixel coords in the 'target' image
         #    (xx, yy)
         # spline outputs -- pixel coords in the 'input' image
@@ -157,11 +203,27 @@ def resample_with_wcs(targetwcs, wcs, Limages=[], L=3, spline=True,
             expand_axes()
             ps.savefig()
     
-        import scipy.interpolate as interp
-        xspline = interp.RectBivariateSpline(xx, yy, XX.T)
-        yspline = interp.RectBivariateSpline(xx, yy, YY.T)
+        # If the target->input mapping is affine to within a small
+        # fraction of a pixel (eg, TAN-to-TAN with similar pointing),
+        # we can skip building and evaluating the splines.
+        gx,gy = np.meshgrid(xx, yy)
+        A = np.vstack((gx.ravel(), gy.ravel(), np.ones(gx.size))).T
+        B = np.vstack((XX.ravel(), YY.ravel())).T
+        affine = np.linalg.lstsq(A, B, rcond=None)[0]
+        xspline = yspline = None
+        if np.max(np.abs(A.dot(affine) - B)) >= 0.01:
+            affine = None
+            import scipy.interpolate as interp
+            xspline = interp.RectBivariateSpline(xx, yy, XX.T)
+            yspline = interp.RectBivariateSpline(xx, yy, YY.T)
+        del gx,gy,A,B
         del XX
         del YY
+        if key is not None:
+            with _spline_cache_lock:
+                if len(_spline_cache) >= _spline_cache_size:
+                    _spline_cache.popitem(last=False)
+                _spline_cache[key] = (affine, xspline, yspline)
 
     else:
         margin = 0
@@ -180,8 +242,16 @@ def resample_with_wcs(targetwcs, wcs, Limages=[], L=3, spline=True,
         # shape n(iyo),n(ixo)
         #
         # f[xy]i: floating-point pixel coords in the input image
-        fxi = xspline(ixo, iyo).T.astype(np.float32)
-        fyi = yspline(ixo, iyo).T.astype(np.float32)
+        if affine is not None:
+            # (same broadcast as the splines)
+            (ax,ay),(bx,by),(cx,cy) = affine
+            fxi = (ax * ixo[np.newaxis,:] + bx * iyo[:,np.newaxis] + cx
+                   ).astype(np.float32)
+            fyi = (ay * ixo[np.newaxis,:] + by * iyo[:,np.newaxis] + cy
+                   ).astype(np.float32)
+        else:
+            fxi = xspline(ixo, iyo).T.astype(np.float32, order='C')
+            fyi = yspline(ixo, iyo).T.astype(np.float32, order='C')
 
         if ps:
             plt.clf()
@@ -221,19 +291,29 @@ def resample_with_wcs(targetwcs, wcs, Limages=[], L=3, spline=True,
         # the lanczos3_interpolate function below requires int32!
         itype = np.int32
 
+    # Cut to in-bounds pixels.  We round with (f + 0.5).astype(int)
+    # below, which truncates toward zero, so the rounded coordinate is
+    # in [0, w) exactly when f is in (-1.5, w - 0.5).  Testing the float
+    # coordinates means we only have to build the (single, boolean)
+    # mask over the full grid, and round just the in-bounds pixels.
+    inbounds = (fxi > -1.5)
+    inbounds &= (fxi < w - 0.5)
+    inbounds &= (fyi > -1.5)
+    inbounds &= (fyi < h - 0.5)
+    # (flat indices, computed once and shared by all the gathers below)
+    K = np.flatnonzero(inbounds)
+    del inbounds
+    fxi = fxi.take(K)
+    fyi = fyi.take(K)
+
     # (f + 0.5).astype(int) is often faster than round().astype(int) or rint!
     ixi = (fxi + 0.5).astype(itype)
     iyi = (fyi + 0.5).astype(itype)
 
-    # Cut to in-bounds pixels.
-    I,J = np.nonzero((ixi >= 0) * (ixi < w) * (iyi >= 0) * (iyi < h))
-    ixi = ixi[I,J]
-    iyi = iyi[I,J]
-    fxi = fxi[I,J]
-    fyi = fyi[I,J]
-
     # i[xy]o: int coords in the target image.
     # These were 1-d arrays that got broadcasted
+    I,J = np.divmod(K, len(ixo))
+    del K
     iyo = iyo[0] + I.astype(intType)
     ixo = ixo[0] + J.astype(intType)
     del I,J
@@ -274,13 +354,15 @@ def resample_with_wcs(targetwcs, wcs, Limages=[], L=3, spline=True,
         NL = 2*L+1
         # accumulators for each input image
         laccs = [np.zeros(nn, np.float32) for im in Limages]
+        # float32 is plenty for Lanczos interpolation, and halves the
+        # memory traffic of the gathers; avoid copying if already float32.
+        limages = [lim.astype(np.float32, copy=False) for lim in Limages]
 
         if cinterp:
             from astrometry.util.util import lanczos3_interpolate
-            rtn = lanczos3_interpolate(ixi, iyi, dx, dy, laccs,
-                                       [lim.astype(np.float32) for lim in Limages])
+            rtn = lanczos3_interpolate(ixi, iyi, dx, dy, laccs, limages)
         else:
-            _lanczos_interpolate(L, ixi, iyi, dx, dy, laccs, Limages, table=table)
+            _lanczos_interpolate(L, ixi, iyi, dx, dy, laccs, limages, table=table)
         rims = laccs
     else:
         rims = []
@@ -298,9 +380,24 @@ def _lanczos_interpolate(L, ixi, iyi, dx, dy, laccs, limages,
     dy:      ----""----                    y
     laccs: list of [float, 1-d numpy array, len n]: outputs
     limages list of [float, 2-d numpy array, shape h,w]: inputs
+
+    If Numba is available, this uses a compiled kernel (ignoring
+    *table*) when called from the main thread.  From other threads it
+    uses the NumPy version, because Numba's default threading layer
+    aborts if two threads run a parallel kernel at the same time.
     '''
+    if threading.current_thread() is threading.main_thread():
+        kernel = _get_numba_kernel()
+        if kernel:
+            for lacc,im in zip(laccs, limages):
+                kernel(L, ixi, iyi, dx, dy, im, lacc)
+            return
+
     from astrometry.util.miscutils import lanczos_filter
-    lfunc = lanczos_filter
+    if table:
+        lfunc = _lanczos_filter_table
+    else:
+        lfunc = lanczos_filter
     if L == 3:
         try:
             from astrometry.util import lanczos3_filter, lanczos3_filter_table
@@ -314,22 +411,148 @@ def _lanczos_interpolate(L, ixi, iyi, dx, dy, laccs, limages,
 
     h,w = limages[0].shape
     n = len(ixi)
+    off = list(range(-L, L+1))
+    # The Lanczos kernel is separable: evaluate the 2L+1 x and y taps
+    # once per pixel, rather than once per (ox,oy) pair.
+    fxs = np.empty((len(off), n), np.float32)
+    fys = np.empty((len(off), n), np.float32)
+    arg = np.empty(n, np.float32)
+    for fx,fy,o in zip(fxs, fys, off):
+        np.subtract(dx, o, out=arg)
+        lfunc(L, arg, fx)
+        np.subtract(dy, o, out=arg)
+        lfunc(L, arg, fy)
     # sum of lanczos terms
-    fsum = np.zeros(n)
-    off = np.arange(-L, L+1)
-    fx = np.zeros(n, np.float32)
-    fy = np.zeros(n, np.float32)
-    for oy in off:
-        lfunc(L, -oy + dy, fy)
-        for ox in off:
-            lfunc(L, -ox + dx, fx)
-            for lacc,im in zip(laccs, limages):
-                lacc += fx * fy * im[np.clip(iyi + oy, 0, h-1),
-                                     np.clip(ixi + ox, 0, w-1)]
-                fsum += fx*fy
-    for lacc in laccs:
+    fsum = np.empty(n, np.float32)
+    fxs.sum(axis=0, out=fsum)
+    fsum *= fys.sum(axis=0)
+    # Clipped pixel coordinates for each x and y offset, shared by all
+    # the images.
+    ixs = np.empty((len(off), n), np.int32)
+    iys = np.empty((len(off), n), np.int32)
+    for ix,iy,o in zip(ixs, iys, off):
+        np.add(ixi, o, out=ix)
+        np.clip(ix, 0, w-1, out=ix)
+        np.add(iyi, o, out=iy)
+        np.clip(iy, 0, h-1, out=iy)
+    # x-direction partial sums, for one row of taps; one per image.
+    accxs = np.empty((len(limages), n), np.float32)
+
+    def accumulate(args):
+        lacc,im,accx = args
+        for fy,iy in zip(fys, iys):
+            accx[:] = 0.
+            for fx,ix in zip(fxs, ixs):
+                pix = im[iy, ix]
+                # accx += fx * pix, without temporaries
+                pix *= fx
+                accx += pix
+            # lacc += fy * accx
+            accx *= fy
+            lacc += accx
         lacc /= fsum
 
+    # The taps are shared by all the images; numpy releases the GIL
+    # during the gathers and arithmetic, so accumulate the images in
+    # parallel threads.
+    nthreads = min(len(limages), multiprocessing.cpu_count())
+    if nthreads > 1:
+        pool = ThreadPool(nthreads)
+        try:
+            pool.map(accumulate, list(zip(laccs, limages, accxs)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for args in zip(laccs, limages, accxs):
+            accumulate(args)
+
+# Lanczos filter look-up tables, keyed by order; built on first use.
+_lanczos_luts = {}
+# number of look-up table samples per unit x
+_lanczos_lut_unit = 1024
+
+def _lanczos_filter_table(order, x, out):
+    '''
+    Like miscutils.lanczos_filter(order, x, out), but linearly
+    interpolating in a look-up table rather than evaluating sin().
+    '''
+    U = _lanczos_lut_unit
+    lut = _lanczos_luts.get(order)
+    if lut is None:
+        from astrometry.util.miscutils import lanczos_filter
+        # samples from x = -order to +order, plus one beyond so that
+        # x = +order can be interpolated.
+        lut = lanczos_filter(order, np.arange(-order * U, order * U + 2) /
+                             float(U)).astype(np.float32)
+        _lanczos_luts[order] = lut
+    t = (np.clip(x, -order, order) + order) * U
+    i = t.astype(np.int32)
+    t -= i
+    out[:] = lut[i] * (1. - t) + lut[i+1] * t
+    return out
+
+# Compiled _lanczos_interpolate_numba, built on first use so that
+# importing this module doesn't import Numba; False if Numba is not
+# available.
+_numba_kernel = None
+# numba.prange once Numba is loaded
+_prange = range
+
+def _get_numba_kernel():
+    global _numba_kernel, _prange
+    if _numba_kernel is None:
+        try:
+            import numba
+        except ImportError:
+            _numba_kernel = False
+        else:
+            _prange = numba.prange
+            _numba_kernel = numba.njit(parallel=True, fastmath=True,
+                                       cache=True)(_lanczos_interpolate_numba)
+    return _numba_kernel
+
+def _lanczos_interpolate_numba(L, ixi, iyi, dx, dy, im, out):
+    '''
+    Numba version of _lanczos_interpolate for a single image (compiled
+    by _get_numba_kernel): one pass over the output pixels, computing
+    the 2L+1 x- and y- Lanczos taps for each pixel and accumulating the
+    weighted image values (and the sum of weights) in registers.
+    '''
+    h,w = im.shape
+    n = len(ixi)
+    NL = 2*L+1
+    for k in _prange(n):
+        wx = np.empty(NL)
+        wy = np.empty(NL)
+        for i in range(NL):
+            # Lanczos kernel evaluated at (dx - ox), ox in [-L, L]
+            x = dx[k] - (i - L)
+            if x == 0.:
+                wx[i] = 1.
+            elif x <= -L or x >= L:
+                wx[i] = 0.
+            else:
+                px = math.pi * x
+                wx[i] = L * math.sin(px) * math.sin(px / L) / (px * px)
+            y = dy[k] - (i - L)
+            if y == 0.:
+                wy[i] = 1.
+            elif y <= -L or y >= L:
+                wy[i] = 0.
+            else:
+                py = math.pi * y
+                wy[i] = L * math.sin(py) * math.sin(py / L) / (py * py)
+        acc = 0.
+        wsum = 0.
+        for i in range(NL):
+            iy = min(max(iyi[k] + i - L, 0), h-1)
+            for j in range(NL):
+                ix = min(max(ixi[k] + j - L, 0), w-1)
+                f = wx[j] * wy[i]
+                acc += f * im[iy, ix]
+                wsum += f
+        out[k] = acc / wsum
 
 
 if __name__ == '__main__':
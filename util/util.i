@@ -17,6 +17,10 @@
 #include <stdlib.h>
 #include <math.h>
 
+#if defined(__AVX2__) && defined(__FMA__)
+#include <immintrin.h>
+#endif
+
 #include "os-features.h"
 #include "log.h"
 #include "healpix.h"